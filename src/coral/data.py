@@ -1,7 +1,10 @@
 """Functions related to the data loading and processing"""
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from itertools import groupby
 import logging
+import multiprocessing as mp
 import os
 import re
 from pathlib import Path
@@ -13,6 +16,7 @@ from datasets import (
     DatasetDict,
     IterableDatasetDict,
     NamedSplit,
+    concatenate_datasets,
     interleave_datasets,
     load_dataset,
 )
@@ -21,6 +25,22 @@ from omegaconf import DictConfig
 logger = logging.getLogger(__package__)
 
 
+SUPERFLUOUS_SPACES_REGEX = re.compile(r" +")
+
+
+NUM_CPUS = mp.cpu_count()
+
+
+# The minimum number of examples to give each process when processing a dataset in
+# parallel, as the overhead of starting a process dominates for fewer examples
+MIN_EXAMPLES_PER_PROCESS = 2_000
+
+
+# A stage in the conversion of characters, being either a translation table for
+# `str.translate` or a regex together with the conversions of the keys it matches
+ConversionStage = dict[int, str] | tuple[re.Pattern[str], dict[str, str]]
+
+
 def load_data(cfg: DictConfig) -> DatasetDict | IterableDatasetDict:
     """Load an audio dataset.
 
@@ -37,98 +57,48 @@ def load_data(cfg: DictConfig) -> DatasetDict | IterableDatasetDict:
     # Note if we're on the main process, if we are running in a distributed setting
     is_main_process = os.getenv("RANK", "0") == "0"
 
-    all_datasets: list[DatasetDict | IterableDatasetDict] = list()
+    # The datasets stored on disk are loaded before any other threads are started, as
+    # caching their resampled audio starts worker processes, and forking a process
+    # while other threads are running can deadlock
+    local_datasets: dict[str, IterableDatasetDict] = dict()
     for dataset_name, dataset_cfg in cfg.datasets.items():
-        if is_main_process:
-            logger.info(f"Loading dataset {dataset_name!r}")
-
-        # Load from disk if the dataset ID is a path
-        if Path(dataset_cfg.id).exists():
-            dataset_paths = {
-                dataset_cfg.train_name: Path(dataset_cfg.id) / dataset_cfg.train_name
-            }
-            if dataset_cfg.val_name is not None:
-                dataset_paths[dataset_cfg.val_name] = (
-                    Path(dataset_cfg.id) / dataset_cfg.val_name
-                )
-            if dataset_cfg.test_name is not None:
-                dataset_paths[dataset_cfg.test_name] = (
-                    Path(dataset_cfg.id) / dataset_cfg.test_name
-                )
-            data_files = {
-                split: list(map(str, split_path.glob("data-*.arrow")))
-                for split, split_path in dataset_paths.items()
-            }
-            for split, files in data_files.items():
-                if len(files) == 0:
-                    raise FileNotFoundError(
-                        f"No data files found for split {split!r} in dataset "
-                        f"{dataset_name!r}. Please check that the provided dataset "
-                        f"directory {dataset_paths[split]!r} contains arrow files of "
-                        "the form 'data-*.arrow'."
-                    )
-            dataset = load_dataset("arrow", data_files=data_files, streaming=True)
-
-        # Load dataset from the Hugging Face Hub. The HUGGINGFACE_HUB_TOKEN is only used
-        # during CI - normally it is expected that the user is logged in to the Hugging
-        # Face Hub using the `huggingface-cli login` command.
-        else:
-            dataset = load_dataset(
-                path=dataset_cfg.id,
-                name=dataset_cfg.subset,
-                token=os.getenv("HUGGINGFACE_HUB_TOKEN", True),
-                streaming=True,
+        data_files = find_local_data_files(
+            dataset_name=dataset_name, dataset_cfg=dataset_cfg
+        )
+        if data_files is not None:
+            if is_main_process:
+                logger.info(f"Loading dataset {dataset_name!r}")
+            local_datasets[dataset_name] = load_local_dataset(
+                cfg=cfg, dataset_cfg=dataset_cfg, data_files=data_files
             )
 
-        assert isinstance(dataset, DatasetDict) or isinstance(
-            dataset, IterableDatasetDict
-        ), f"Unsupported dataset type: {type(dataset)}"
-
-        train = dataset[dataset_cfg.train_name]
-        if dataset_cfg.val_name is not None:
-            val = dataset[dataset_cfg.val_name]
-        else:
-            val = None
-        if dataset_cfg.test_name is not None:
-            test = dataset[dataset_cfg.test_name]
-        else:
-            test = None
-
-        splits_dict = dict(train=train)
-        if val is not None:
-            splits_dict["val"] = val
-        if test is not None:
-            splits_dict["test"] = test
-
-        if isinstance(dataset, DatasetDict):
-            dataset = DatasetDict(splits_dict)
-        elif isinstance(dataset, IterableDatasetDict):
-            dataset = IterableDatasetDict(splits_dict)
-        else:
-            raise ValueError(f"Unsupported dataset type: {type(dataset)}")
-
-        if dataset_cfg.text_column != "text":
-            dataset = dataset.rename_column(dataset_cfg.text_column, "text")
-
-        if dataset_cfg.audio_column != "audio":
-            dataset = dataset.rename_column(dataset_cfg.audio_column, "audio")
-
-        dataset = dataset.cast_column(
-            column="audio", feature=Audio(sampling_rate=cfg.model.sampling_rate)
-        )
-        dataset = dataset.remove_columns(
-            [
-                column
-                for column in dataset["train"].column_names
-                if column not in ["audio", "text"]
-            ]
+    # We open the datasets on the Hugging Face Hub concurrently, as this mostly
+    # consists of waiting for the Hub. The processing of the datasets is CPU-bound, and
+    # is done sequentially afterwards
+    hub_dataset_names = [name for name in cfg.datasets if name not in local_datasets]
+    num_workers = max(1, min(8, len(hub_dataset_names)))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        hub_datasets = dict(
+            zip(
+                hub_dataset_names,
+                executor.map(
+                    partial(load_hub_dataset, is_main_process=is_main_process),
+                    hub_dataset_names,
+                    [cfg.datasets[name] for name in hub_dataset_names],
+                ),
+            )
         )
-        dataset = dataset.shuffle(seed=cfg.seed)
 
-        if cfg.model.clean_dataset:
-            dataset = clean_dataset(cfg, dataset=dataset)
-
-        all_datasets.append(dataset)
+    loaded_datasets: dict[str, DatasetDict | IterableDatasetDict] = {
+        **local_datasets,
+        **hub_datasets,
+    }
+    all_datasets: list[DatasetDict | IterableDatasetDict] = [
+        prepare_single_dataset(
+            cfg=cfg, dataset=loaded_datasets[dataset_name], dataset_cfg=dataset_cfg
+        )
+        for dataset_name, dataset_cfg in cfg.datasets.items()
+    ]
 
     assert len(all_datasets) > 0, "No datasets were loaded"
 
@@ -219,12 +189,258 @@ def load_data(cfg: DictConfig) -> DatasetDict | IterableDatasetDict:
         else:
             dataset = IterableDatasetDict(data_dict)
 
+        if not cfg.pre_shuffle:
+            dataset = dataset.shuffle(
+                seed=cfg.seed, buffer_size=cfg.shuffle_buffer_size
+            )
+
     else:
         dataset = all_datasets[0]
 
     return dataset
 
 
+def load_hub_dataset(
+    dataset_name: str, dataset_cfg: DictConfig, is_main_process: bool
+) -> DatasetDict | IterableDatasetDict:
+    """Open an audio dataset on the Hugging Face Hub, streaming it.
+
+    The HUGGINGFACE_HUB_TOKEN is only used during CI - normally it is expected that
+    the user is logged in to the Hugging Face Hub using the `huggingface-cli login`
+    command.
+
+    Args:
+        dataset_name:
+            The name of the dataset.
+        dataset_cfg:
+            The configuration of the dataset.
+        is_main_process:
+            Whether this is the main process, in a distributed setting.
+
+    Returns:
+        The audio dataset.
+    """
+    if is_main_process:
+        logger.info(f"Loading dataset {dataset_name!r}")
+    dataset = load_dataset(
+        path=dataset_cfg.id,
+        name=dataset_cfg.subset,
+        token=os.getenv("HUGGINGFACE_HUB_TOKEN", True),
+        streaming=True,
+    )
+    assert isinstance(dataset, DatasetDict) or isinstance(
+        dataset, IterableDatasetDict
+    ), f"Unsupported dataset type: {type(dataset)}"
+    return dataset
+
+
+def prepare_single_dataset(
+    cfg: DictConfig, dataset: DatasetDict | IterableDatasetDict, dataset_cfg: DictConfig
+) -> DatasetDict | IterableDatasetDict:
+    """Prepare a single loaded audio dataset for interleaving with the others.
+
+    Args:
+        cfg:
+            The Hydra configuration object.
+        dataset:
+            The loaded dataset.
+        dataset_cfg:
+            The configuration of the dataset.
+
+    Returns:
+        The audio dataset, with "train" and optionally "val" and "test" splits.
+
+    Raises:
+        ValueError:
+            If the dataset is not supported.
+    """
+    train = dataset[dataset_cfg.train_name]
+    if dataset_cfg.val_name is not None:
+        val = dataset[dataset_cfg.val_name]
+    else:
+        val = None
+    if dataset_cfg.test_name is not None:
+        test = dataset[dataset_cfg.test_name]
+    else:
+        test = None
+
+    splits_dict = dict(train=train)
+    if val is not None:
+        splits_dict["val"] = val
+    if test is not None:
+        splits_dict["test"] = test
+
+    if isinstance(dataset, DatasetDict):
+        dataset = DatasetDict(splits_dict)
+    elif isinstance(dataset, IterableDatasetDict):
+        dataset = IterableDatasetDict(splits_dict)
+    else:
+        raise ValueError(f"Unsupported dataset type: {type(dataset)}")
+
+    if dataset_cfg.text_column != "text":
+        dataset = dataset.rename_column(dataset_cfg.text_column, "text")
+
+    if dataset_cfg.audio_column != "audio":
+        dataset = dataset.rename_column(dataset_cfg.audio_column, "audio")
+
+    # We only decode the audio after the text processing, as the audio would
+    # otherwise be decoded by every `map` call
+    dataset = dataset.cast_column(
+        column="audio",
+        feature=Audio(sampling_rate=cfg.model.sampling_rate, decode=False),
+    )
+    dataset = dataset.remove_columns(
+        [
+            column
+            for column in dataset["train"].column_names
+            if column not in ["audio", "text"]
+        ]
+    )
+
+    # When several datasets are interleaved they are by default only shuffled after
+    # the interleaving, which only requires a single shuffle buffer
+    if cfg.pre_shuffle or len(cfg.datasets) == 1:
+        dataset = dataset.shuffle(seed=cfg.seed, buffer_size=cfg.shuffle_buffer_size)
+
+    if cfg.model.clean_dataset:
+        dataset = clean_dataset(cfg, dataset=dataset)
+
+    dataset = dataset.cast_column(
+        column="audio", feature=Audio(sampling_rate=cfg.model.sampling_rate)
+    )
+
+    return dataset
+
+
+def load_local_dataset(
+    cfg: DictConfig, dataset_cfg: DictConfig, data_files: dict[str, list[str]]
+) -> IterableDatasetDict:
+    """Load an audio dataset stored on disk.
+
+    We memory-map the arrow files directly rather than loading them with
+    `load_dataset`, and stream them with one shard per file, which allows the
+    dataloader workers to share the files.
+
+    Args:
+        cfg:
+            The Hydra configuration object.
+        dataset_cfg:
+            The configuration of the dataset.
+        data_files:
+            The arrow files for each split.
+
+    Returns:
+        The audio dataset, with a split for each entry in `data_files`.
+    """
+    dataset = IterableDatasetDict()
+    for split, files in data_files.items():
+        split_dataset = concatenate_datasets(
+            [Dataset.from_file(filename=file) for file in sorted(files)]
+        )
+        if cfg.cache_resampled_audio:
+            split_dataset = cache_resampled_audio(
+                dataset=split_dataset,
+                audio_column=dataset_cfg.audio_column,
+                sampling_rate=cfg.model.sampling_rate,
+            )
+        dataset[split] = split_dataset.to_iterable_dataset(num_shards=len(files))
+    return dataset
+
+
+def cache_resampled_audio(
+    dataset: Dataset, audio_column: str, sampling_rate: int
+) -> Dataset:
+    """Resample the audio in a dataset once and store it in the dataset cache.
+
+    The resampled audio is written to an arrow cache file next to the dataset, which
+    is memory-mapped and reused in every epoch and in later runs, so the audio only
+    has to be resampled once.
+
+    Args:
+        dataset:
+            The dataset with the audio to be resampled.
+        audio_column:
+            The name of the audio column.
+        sampling_rate:
+            The sampling rate to resample the audio to.
+
+    Returns:
+        The dataset with the resampled audio.
+    """
+    dataset = dataset.cast_column(
+        column=audio_column, feature=Audio(sampling_rate=sampling_rate)
+    )
+    return dataset.map(
+        function=lambda examples: {audio_column: examples[audio_column]},
+        batched=True,
+        batch_size=64,
+        writer_batch_size=64,
+        num_proc=get_num_proc(num_examples=len(dataset)),
+        desc="Resampling audio",
+    )
+
+
+def get_num_proc(num_examples: int) -> int:
+    """Get the number of processes to use when processing a dataset in parallel.
+
+    Args:
+        num_examples:
+            The number of examples in the dataset.
+
+    Returns:
+        The number of processes, which leaves one CPU free and gives each process at
+        least `MIN_EXAMPLES_PER_PROCESS` examples.
+    """
+    return max(1, min(NUM_CPUS - 1, num_examples // MIN_EXAMPLES_PER_PROCESS))
+
+
+def find_local_data_files(
+    dataset_name: str, dataset_cfg: DictConfig
+) -> dict[str, list[str]] | None:
+    """Find the arrow files of a dataset stored on disk.
+
+    Args:
+        dataset_name:
+            The name of the dataset.
+        dataset_cfg:
+            The configuration of the dataset.
+
+    Returns:
+        The arrow files for each split, or None if the dataset ID is not a path.
+
+    Raises:
+        FileNotFoundError:
+            If the dataset directory does not contain arrow files for a split.
+    """
+    if not Path(dataset_cfg.id).exists():
+        return None
+
+    dataset_paths = {
+        dataset_cfg.train_name: Path(dataset_cfg.id) / dataset_cfg.train_name
+    }
+    if dataset_cfg.val_name is not None:
+        dataset_paths[dataset_cfg.val_name] = (
+            Path(dataset_cfg.id) / dataset_cfg.val_name
+        )
+    if dataset_cfg.test_name is not None:
+        dataset_paths[dataset_cfg.test_name] = (
+            Path(dataset_cfg.id) / dataset_cfg.test_name
+        )
+    data_files = {
+        split: list(map(str, split_path.glob("data-*.arrow")))
+        for split, split_path in dataset_paths.items()
+    }
+    for split, files in data_files.items():
+        if len(files) == 0:
+            raise FileNotFoundError(
+                f"No data files found for split {split!r} in dataset "
+                f"{dataset_name!r}. Please check that the provided dataset "
+                f"directory {dataset_paths[split]!r} contains arrow files of "
+                "the form 'data-*.arrow'."
+            )
+    return data_files
+
+
 def clean_dataset(
     cfg: DictConfig, dataset: DatasetDict | IterableDatasetDict
 ) -> DatasetDict | IterableDatasetDict:
@@ -287,25 +503,86 @@ def clean_dataset(
         f"[^{re.escape(cfg.characters_to_keep + ' |')}]"
     )
 
-    mapped = dataset.map(
-        partial(
-            clean_example,
-            non_standard_characters_regex=non_standard_characters_regex,
-            conversion_dict=conversion_dict,
-        )
+    clean_fn = partial(
+        clean_examples,
+        non_standard_characters_regex=non_standard_characters_regex,
+        conversion_stages=compile_conversion_dict(conversion_dict=conversion_dict),
+    )
+    return type(dataset)(
+        {
+            split: split_dataset.map(
+                clean_fn, batched=True, features=split_dataset.features
+            )
+            for split, split_dataset in dataset.items()
+        }
     )
 
-    # After calling `map` the DatasetInfo is lost, so we need to add it back in
-    for split in dataset.keys():
-        mapped[split]._info = dataset[split]._info
 
-    return mapped
+def compile_conversion_dict(conversion_dict: dict[str, str]) -> list[ConversionStage]:
+    """Compile a conversion dictionary into a list of conversion stages.
+
+    Consecutive single-character keys are collected into a translation table, to be
+    used with `str.translate`, and consecutive multi-character keys are collected into
+    a single alternation regex. Each stage is thus a single pass over a document, and
+    the stages preserve the order in which the keys appear in the dictionary. The keys
+    of a stage are either all ASCII or all non-ASCII, which allows skipping the
+    non-ASCII stages for ASCII documents.
+
+    Args:
+        conversion_dict:
+            A dictionary of characters to be converted.
+
+    Returns:
+        The conversion stages, being either translation tables or pairs of a compiled
+        regex and the conversions of the keys it matches.
+    """
+    stages: list[ConversionStage] = list()
+    for (is_single_character, _), group in groupby(
+        conversion_dict.items(), key=lambda item: (len(item[0]) == 1, item[0].isascii())
+    ):
+        conversions = dict(group)
+        if is_single_character:
+            stages.append(str.maketrans(conversions))
+        else:
+            regex = re.compile("|".join(re.escape(key) for key in conversions))
+            stages.append((regex, conversions))
+    return stages
+
+
+def clean_examples(
+    examples: dict,
+    non_standard_characters_regex: re.Pattern[str],
+    conversion_stages: list[ConversionStage],
+) -> dict:
+    """Helper function which cleans a batch of examples.
+
+    Args:
+        examples:
+            The batch of examples to be cleaned.
+        non_standard_characters_regex:
+            A compiled regex expression that matches all non-standard characters.
+        conversion_stages:
+            The stages converting characters, as returned by
+            `compile_conversion_dict`.
+
+    Returns:
+        The cleaned batch of examples.
+    """
+    examples["text"] = [
+        clean_transcription(
+            transcription=doc,
+            non_standard_characters_regex=non_standard_characters_regex,
+            conversion_stages=conversion_stages,
+        )
+        for doc in examples["text"]
+    ]
+    return examples
 
 
 def clean_example(
     example: dict,
     non_standard_characters_regex: re.Pattern[str],
-    conversion_dict: dict[str, str],
+    conversion_stages: list[ConversionStage],
 ) -> dict:
     """Helper function which cleans a single example.
 
@@ -314,28 +591,62 @@ def clean_example(
             The example to be cleaned.
         non_standard_characters_regex:
             A compiled regex expression that matches all non-standard characters.
-        conversion_dict:
-            A dictionary of characters to be converted.
+        conversion_stages:
+            The stages converting characters, as returned by
+            `compile_conversion_dict`.
 
     Returns:
         The cleaned example.
     """
-    doc = example["text"]
+    example["text"] = clean_transcription(
+        transcription=example["text"],
+        non_standard_characters_regex=non_standard_characters_regex,
+        conversion_stages=conversion_stages,
+    )
+    return example
 
-    # Normalise the transcription, which uniformises the characters. For instance, the
-    # "long dash" (－) is converted to the normal dash (-).
-    doc = normalize("NFKC", doc)
 
-    for key, value in conversion_dict.items():
-        doc = doc.replace(key, value)
+def clean_transcription(
+    transcription: str,
+    non_standard_characters_regex: re.Pattern[str],
+    conversion_stages: list[ConversionStage],
+) -> str:
+    """Clean a single transcription.
 
-    # Replace superfluous spaces
-    doc = re.sub(r" +", " ", doc)
+    Args:
+        transcription:
+            The transcription to be cleaned.
+        non_standard_characters_regex:
+            A compiled regex expression that matches all non-standard characters.
+        conversion_stages:
+            The stages converting characters, as returned by
+            `compile_conversion_dict`.
 
-    # Remove all non-standard characters, and make the document lower case
-    doc = re.sub(non_standard_characters_regex, "", doc.lower().strip())
+    Returns:
+        The cleaned transcription.
+    """
+    # Normalise the transcription, which uniformises the characters. For instance, the
+    # "long dash" (－) is converted to the normal dash (-). ASCII transcriptions are
+    # already normalised, so we skip those.
+    is_ascii = transcription.isascii()
+    doc = transcription if is_ascii else normalize("NFKC", transcription)
+
+    # The stages with non-ASCII keys cannot match an ASCII document, so we skip those
+    # for as long as the document stays ASCII
+    for stage in conversion_stages:
+        if isinstance(stage, dict):
+            if is_ascii and next(iter(stage)) >= 128:
+                continue
+            doc = doc.translate(stage)
+        else:
+            regex, conversions = stage
+            if is_ascii and not next(iter(conversions)).isascii():
+                continue
+            doc = regex.sub(lambda match: conversions[match.group()], doc)
+        is_ascii = is_ascii and doc.isascii()
 
-    # Re-assign the cleaned transcription
-    example["text"] = doc
+    # Replace superfluous spaces
+    doc = SUPERFLUOUS_SPACES_REGEX.sub(" ", doc)
 
-    return example
+    # Remove all non-standard characters, and make the document lower case
+    return non_standard_characters_regex.sub("", doc.lower().strip())
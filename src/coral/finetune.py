@@ -1,11 +1,19 @@
 """Functions related to the finetuning of Wav2Vec 2.0 models on ASR datasets."""
 
 from functools import partial
+import io
 import logging
-from typing import Callable
+import queue
+import random
+import threading
+from typing import Callable, Iterator
 import os
 
+from datasets import Audio, IterableDataset
+import numpy as np
 from omegaconf import DictConfig
+import soundfile as sf
+from torch.utils.data import IterableDataset as TorchIterableDataset
 from transformers import EarlyStoppingCallback, TrainerCallback
 from wandb.sdk.wandb_init import init as wandb_init
 from wandb.sdk.wandb_run import finish as wandb_finish
@@ -18,45 +26,281 @@ from .protocols import ModelSetup
 logger = logging.getLogger(__package__)
 
 
-def prepare_dataset_example(example: dict, processor: Callable) -> dict:
-    """Prepare a dataset example for the model.
+class PrefetchedIterableDataset(TorchIterableDataset):
+    """Iterable dataset that prefetches examples in a background thread.
+
+    This allows the decoding and processing of the upcoming examples to happen while
+    the model is training on the current batch.
+
+    Args:
+        dataset (IterableDataset):
+            The dataset to prefetch examples from.
+        buffer_size (int):
+            The maximum number of examples to prefetch.
+    """
+
+    def __init__(
+        self, dataset: IterableDataset | TorchIterableDataset, buffer_size: int
+    ) -> None:
+        """Initialise the prefetched dataset."""
+        self.dataset = dataset
+        self.buffer_size = buffer_size
+
+    def __iter__(self) -> Iterator[dict]:
+        """Iterate over the examples in the dataset.
+
+        Yields:
+            The examples in the dataset.
+        """
+        buffer: queue.Queue = queue.Queue(maxsize=self.buffer_size)
+        stop_event = threading.Event()
+        end_of_dataset = object()
+        errors: list[BaseException] = list()
+
+        def put_in_buffer(item: object) -> bool:
+            """Put an item in the buffer, unless the iteration has been stopped."""
+            while not stop_event.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def prefetch() -> None:
+            """Prefetch the examples in the dataset into the buffer.
+
+            The end of the dataset is always marked in the buffer, also if the
+            iteration fails, as the consumer would otherwise wait forever.
+            """
+            try:
+                for example in self.dataset:
+                    if not put_in_buffer(item=example):
+                        return
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                put_in_buffer(item=end_of_dataset)
+
+        thread = threading.Thread(target=prefetch, daemon=True)
+        thread.start()
+        try:
+            while (item := buffer.get()) is not end_of_dataset:
+                yield item
+            if errors:
+                raise errors[0]
+        finally:
+            stop_event.set()
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch of the dataset, which is used to reshuffle it.
+
+        Args:
+            epoch: The epoch number.
+        """
+        if hasattr(self.dataset, "set_epoch"):
+            self.dataset.set_epoch(epoch)
+
+
+class LengthGroupedIterableDataset(TorchIterableDataset):
+    """Iterable dataset that groups examples of similar length into batches.
+
+    The examples are read into a buffer, sorted by length and split into batches,
+    which are then yielded in a random order. Batches of examples with similar lengths
+    need less padding and take similar amounts of time to process.
+
+    Args:
+        dataset (IterableDataset):
+            The dataset to group the examples of.
+        batch_size (int):
+            The number of examples in each batch.
+        buffer_size (int):
+            The number of examples to group at a time, which is rounded down to a
+            multiple of the batch size.
+        seed (int):
+            The seed used to shuffle the batches.
+    """
+
+    def __init__(
+        self,
+        dataset: IterableDataset | TorchIterableDataset,
+        batch_size: int,
+        buffer_size: int,
+        seed: int,
+    ) -> None:
+        """Initialise the length grouped dataset."""
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.buffer_size = max(1, buffer_size // batch_size) * batch_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self) -> Iterator[dict]:
+        """Iterate over the examples in the dataset.
+
+        Yields:
+            The examples in the dataset, grouped by length.
+        """
+        rng = random.Random(self.seed + self.epoch)
+        buffer: list[dict] = list()
+        for example in self.dataset:
+            buffer.append(example)
+            if len(buffer) == self.buffer_size:
+                yield from self.group_by_length(examples=buffer, rng=rng)
+                buffer = list()
+        yield from self.group_by_length(examples=buffer, rng=rng)
+
+    def group_by_length(self, examples: list[dict], rng: random.Random) -> list[dict]:
+        """Group examples of similar length into batches, in a random batch order.
+
+        Args:
+            examples: The examples to group.
+            rng: The random number generator used to shuffle the batches.
+
+        Returns:
+            The examples, ordered such that consecutive batches have similar lengths.
+        """
+        examples = sorted(examples, key=get_example_length)
+        batches = [
+            examples[idx : idx + self.batch_size]
+            for idx in range(0, len(examples), self.batch_size)
+        ]
+
+        # We keep an incomplete batch at the end, so that it does not shift the
+        # boundaries of the following batches
+        full_batches = [batch for batch in batches if len(batch) == self.batch_size]
+        incomplete_batches = [
+            batch for batch in batches if len(batch) < self.batch_size
+        ]
+        rng.shuffle(full_batches)
+        return [
+            example for batch in full_batches + incomplete_batches for example in batch
+        ]
+
+    def set_epoch(self, epoch: int) -> None:
+        """Set the epoch of the dataset, which is used to reshuffle it.
+
+        Args:
+            epoch: The epoch number.
+        """
+        self.epoch = epoch
+        if hasattr(self.dataset, "set_epoch"):
+            self.dataset.set_epoch(epoch)
+
+
+def prepare_dataset_examples(
+    examples: dict,
+    processor: Callable,
+    max_seconds_per_example: int,
+    sampling_rate: int,
+) -> dict:
+    """Prepare a batch of dataset examples for the model.
+
+    The examples whose audio is too long are removed before their audio is decoded,
+    so the audio is expected to not be decoded.
 
     Args:
-        example: The example from the dataset.
+        examples: The batch of examples from the dataset.
         processor: The processor to use.
+        max_seconds_per_example: The maximum number of seconds per example.
+        sampling_rate: The sampling rate to decode the audio with.
 
     Returns:
-        The prepared example.
+        The prepared examples which are short enough.
     """
+    audio_feature = Audio(sampling_rate=sampling_rate)
+    is_short = examples_audio_are_short(
+        audios=examples["audio"], max_seconds_per_example=max_seconds_per_example
+    )
+    audios = [
+        audio_feature.decode_example(value=audio)["array"]
+        for audio, keep in zip(examples["audio"], is_short)
+        if keep
+    ]
+    texts = [text for text, keep in zip(examples["text"], is_short) if keep]
+
+    # We always include the labels, as the batch would otherwise be empty if none of
+    # the examples are short enough
+    prepared: dict[str, list] = dict(labels=list(), input_length=list())
+    if len(audios) == 0:
+        return prepared
+
     # Prepare audio
-    audio = example["audio"]
-    sampling_rate = audio["sampling_rate"]
-    processed = processor(audio["array"], sampling_rate=sampling_rate)
+    processed = processor(audios, sampling_rate=sampling_rate)
     if "input_values" in processed:
-        example["input_values"] = processed.input_values[0]
-        example["num_seconds"] = len(example["input_values"]) / sampling_rate
+        prepared["input_values"] = list(processed.input_values)
     if "input_features" in processed:
-        example["input_features"] = processed.input_features[0]
-        example["num_seconds"] = len(example["input_features"]) / sampling_rate
+        # The spectrograms are stored in half precision, which halves the memory used
+        # by the shuffle and prefetch buffers. They are upcast again in the collator
+        prepared["input_features"] = [
+            features.astype(np.float16) for features in processed.input_features
+        ]
 
     # Prepare transcriptions
-    example["labels"] = processor(text=example["text"], truncation=True).input_ids
-    example["input_length"] = len(example["labels"])
+    prepared["labels"] = processor(text=texts, truncation=True).input_ids
+    prepared["input_length"] = [len(labels) for labels in prepared["labels"]]
+
+    return prepared
+
+
+def get_example_length(example: dict) -> int:
+    """Get the length of a prepared example.
+
+    This is the length of the audio input if it has a variable length, and otherwise
+    the length of the labels.
+
+    Args:
+        example: The prepared example from the dataset.
+
+    Returns:
+        The length of the example.
+    """
+    if "input_values" in example:
+        return len(example["input_values"])
+    return len(example["labels"])
 
-    return example
 
+def examples_audio_are_short(
+    audios: list[dict], max_seconds_per_example: int
+) -> list[bool]:
+    """Check if the audio of a batch of examples is short enough.
 
-def example_audio_is_short(example: dict, max_seconds_per_example: int) -> bool:
-    """Check if the example audio is too short.
+    The audio is expected to not be decoded, as the durations are read from the
+    headers of the audio files.
 
     Args:
-        example: The example from the dataset.
+        audios: The audio of the batch of examples from the dataset.
         max_seconds_per_example: The maximum number of seconds per example.
 
     Returns:
-        Whether the example audio is too short.
+        Whether the audio of each example is short enough.
     """
-    return example["num_seconds"] <= max_seconds_per_example
+    return [
+        get_audio_duration(audio=audio) <= max_seconds_per_example for audio in audios
+    ]
+
+
+def get_audio_duration(audio: dict) -> float:
+    """Get the duration of an undecoded audio example.
+
+    Args:
+        audio: The undecoded audio, with the keys "bytes" and "path".
+
+    Returns:
+        The duration of the audio, in seconds.
+    """
+    try:
+        if audio["bytes"] is not None:
+            info = sf.info(io.BytesIO(audio["bytes"]))
+        else:
+            info = sf.info(audio["path"])
+        return info.frames / info.samplerate
+
+    # If the header cannot be read by `soundfile` then we fall back to decoding the
+    # audio
+    except RuntimeError:
+        decoded = Audio().decode_example(value=audio)
+        return len(decoded["array"]) / decoded["sampling_rate"]
 
 
 def finetune(cfg: DictConfig) -> None:
@@ -74,17 +318,40 @@ def finetune(cfg: DictConfig) -> None:
     model = model_setup.load_model()
     dataset = load_data(cfg)
 
+    # We filter and prepare the dataset in a single pass, and only decode the audio of
+    # the examples that are kept
+    dataset = dataset.cast_column(column="audio", feature=Audio(decode=False))
     dataset = dataset.map(
-        function=partial(prepare_dataset_example, processor=processor),
-        remove_columns=dataset["train"].column_names,
-    )
-    dataset = dataset.filter(
         function=partial(
-            example_audio_is_short,
+            prepare_dataset_examples,
+            processor=processor,
             max_seconds_per_example=cfg.max_seconds_per_example,
+            sampling_rate=cfg.model.sampling_rate,
         ),
+        batched=True,
+        batch_size=cfg.preprocessing_batch_size,
+        remove_columns=dataset["train"].column_names,
     )
 
+    train_dataset = dataset["train"]
+    eval_dataset = dataset["val"] if "val" in dataset else None
+    if cfg.group_by_length:
+        train_dataset = LengthGroupedIterableDataset(
+            dataset=train_dataset,
+            batch_size=cfg.per_device_batch_size,
+            buffer_size=cfg.shuffle_buffer_size,
+            seed=cfg.seed,
+        )
+    if cfg.prefetch_batches > 0:
+        buffer_size = cfg.prefetch_batches * cfg.per_device_batch_size
+        train_dataset = PrefetchedIterableDataset(
+            dataset=train_dataset, buffer_size=buffer_size
+        )
+        if eval_dataset is not None:
+            eval_dataset = PrefetchedIterableDataset(
+                dataset=eval_dataset, buffer_size=buffer_size
+            )
+
     if cfg.wandb and is_main_process:
         wandb_init(
             project=cfg.wandb_project,
@@ -101,8 +368,8 @@ def finetune(cfg: DictConfig) -> None:
         data_collator=model_setup.load_data_collator(),
         args=model_setup.load_training_arguments(),
         compute_metrics=model_setup.load_compute_metrics(),
-        train_dataset=dataset["train"],
-        eval_dataset=dataset["val"] if "val" in dataset else None,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
         tokenizer=getattr(processor, "tokenizer"),
         callbacks=load_early_stopping_callback(cfg) if "val" in dataset else None,
     )
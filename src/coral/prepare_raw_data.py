@@ -1,8 +1,11 @@
 """Functions for preparing the raw data"""
 
+import contextlib
 import datetime
+import os
 import sqlite3
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from zlib import adler32
 
@@ -178,9 +181,9 @@ def make_speaker_metadata(raw_path: Path, metadata_path: Path) -> pd.DataFrame:
     # Load speaker information from read aloud data
     read_aloud_paths = raw_path.glob("*_oplæst_*")
     for read_aloud_path in read_aloud_paths:
-        read_aloud_data = get_data_from_db(read_aloud_path)
-
-        read_aloud_data_speakers = read_aloud_data[DB_TO_EXCEL_METADATA_NAMES.keys()]
+        read_aloud_data_speakers = get_data_from_db(
+            read_aloud_path, columns=list(DB_TO_EXCEL_METADATA_NAMES.keys())
+        )
         read_aloud_data_speakers = read_aloud_data_speakers.rename(
             columns=DB_TO_EXCEL_METADATA_NAMES
         )
@@ -328,27 +331,33 @@ def make_recording_metadata(
         # Make sentence_id columns from content
         # We changed the set of sentences during the project, so we need to check if
         # the sentence is in the sentence list. If it is not, we set the sentence_id to
-        # the next available id.
-        read_aloud_data["sentence_id"] = -1
-        for row_i, row in read_aloud_data.iterrows():
-            if row["transcription"] not in sentences["text"].values:
-                # Append new sentence to sentences dataframe
-                sentences = pd.concat(
-                    [
-                        sentences,
-                        pd.DataFrame(
-                            {
-                                "text": [row["transcription"]],
-                                "sentence_id": len(sentences),
-                            }
-                        ),
-                    ],
-                    ignore_index=True,
-                )
-
-            read_aloud_data.loc[row_i, "sentence_id"] = sentences[
-                sentences["text"] == row["transcription"]
-            ].index[0]
+        # the next available id. New sentences are appended in the order they first
+        # appear, and every sentence gets the index of its first occurrence.
+        transcriptions = read_aloud_data["transcription"]
+        new_sentences = pd.unique(
+            transcriptions[~transcriptions.isin(sentences["text"])]
+        )
+        if len(new_sentences) > 0:
+            sentences = pd.concat(
+                [
+                    sentences,
+                    pd.DataFrame(
+                        {
+                            "text": new_sentences,
+                            "sentence_id": range(
+                                len(sentences), len(sentences) + len(new_sentences)
+                            ),
+                        }
+                    ),
+                ],
+                ignore_index=True,
+            )
+        text_to_sentence_id = (
+            pd.Series(sentences.index, index=sentences["text"])
+            .groupby(level=0, sort=False)
+            .first()
+        )
+        read_aloud_data["sentence_id"] = transcriptions.map(text_to_sentence_id)
 
         # Make a recorder_id. This is not in the read aloud data, as no we have
         # no information about the recorders for the read aloud data.
@@ -480,23 +489,23 @@ def prepare_raw_data(
     if not processed_audio_path.exists():
         processed_audio_path.mkdir()
 
-    rows_to_remove: list[int] = []
-
-    def change_codec_and_rename_files(row: pd.Series, row_i: int) -> None:
+    def change_codec_and_rename_files(row: pd.Series) -> Path | None:
         """
         Convert the audio files to .wav and place them in the output path.
 
         Args:
             row (pd.Series): A row in the recording metadata dataframe
-            row_i (int): The index of the row in the recording metadata dataframe
+
+        Returns:
+            Path or None: The path to the converted audio file, or None if the audio
+                file is empty
         """
         filename = input_path / row["filename"]
 
-        # Check if the file is empty, and if it is, remove it from the dataframe
-        # and continue to the next file
+        # Check if the file is empty, and if it is, skip it so that it can be removed
+        # from the dataframe
         if filename.stat().st_size < 10000:  # Any file smaller than this is empty
-            rows_to_remove.append(row_i)
-            return
+            return None
 
         # Get the new filename
         # New filename is in the format is for conversations:
@@ -516,9 +525,6 @@ def prepare_raw_data(
             / f"{row['recording_id']}_{speaker_id}_{sentence_id}.wav"
         )
 
-        # Update the filename in the recording metadata
-        recordings.loc[row_i, "filename"] = new_filename
-
         # If the file is an .webm file, convert it to .wav
         subprocess.run(
             [
@@ -536,13 +542,20 @@ def prepare_raw_data(
             ],
             stdout=subprocess.DEVNULL,
         )
+        return new_filename
+
+    # Convert the audio files and rename them. Every conversion runs in its own
+    # `ffmpeg` process, so we use threads to run a conversion on every CPU at a time
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        new_filenames = list(
+            executor.map(
+                change_codec_and_rename_files, (row for _, row in recordings.iterrows())
+            )
+        )
 
-    # Convert the audio files and rename them
-    for row_i, row in recordings.iterrows():
-        change_codec_and_rename_files(row, row_i)
-
-    # Remove rows with empty files
-    recordings = recordings.drop(rows_to_remove).reset_index(drop=True)
+    # Update the filenames in the recording metadata, and remove rows with empty files
+    recordings["filename"] = new_filenames
+    recordings = recordings[recordings["filename"].notna()].reset_index(drop=True)
 
     # Write a README file
     readme = make_readme()
@@ -636,20 +649,38 @@ def correct_timestamp(timestamp: str) -> str:
         return timestamp
 
 
-def get_data_from_db(db_folder: Path) -> pd.DataFrame:
+def get_data_from_db(db_folder: Path, columns: list[str] | None = None) -> pd.DataFrame:
     """Gets the data from the database
 
     Args:
         db_folder (Path): The path to the folder containing the database
             the database should be named "db.sqlite3"
+        columns (list of str or None, optional): The columns to select. Only these
+            columns are read from the database. If None then all columns are
+            selected. Defaults to None.
 
     Returns:
         pd.DataFrame: The data from the database
     """
-    connection = sqlite3.connect(db_folder / "db.sqlite3")
-    read_aloud_data = pd.read_sql_query(
-        sql="SELECT * FROM CoRal_recording", con=connection
-    )
+    if columns is None:
+        selection = "*"
+    else:
+        selection = ", ".join(f'"{column}"' for column in columns)
+
+    # The database is only read from, so we open it in read-only mode and let SQLite
+    # memory-map it, which avoids copying the pages through read calls
+    db_uri = (db_folder / "db.sqlite3").resolve().as_uri() + "?mode=ro"
+    with contextlib.closing(sqlite3.connect(db_uri, uri=True)) as connection:
+        connection.execute("PRAGMA query_only = 1")
+        connection.execute("PRAGMA mmap_size = 30000000000")
+
+        # Keep any temporary sorting structures in memory, and use a 512 MB page cache
+        # instead of the default 2 MB
+        connection.execute("PRAGMA temp_store = MEMORY")
+        connection.execute("PRAGMA cache_size = -524288")
+        read_aloud_data = pd.read_sql_query(
+            sql=f"SELECT {selection} FROM CoRal_recording", con=connection
+        )
     return read_aloud_data
 
 
@@ -3,9 +3,10 @@
 import contextlib
 import logging
 import warnings
-from functools import partialmethod
+from functools import cache, partialmethod
 
 import datasets.utils.logging as ds_logging
+import torch
 import tqdm
 import transformers.utils.logging as hf_logging
 from datasets.utils import disable_progress_bar
@@ -32,13 +33,30 @@ def block_terminal_output() -> None:
 
 
 class transformers_output_ignored:
-    """Context manager to block terminal output."""
+    """Context manager to block terminal output.
+
+    The verbosity of the `transformers` logger is restored to what it was before
+    entering the context manager.
+    """
 
     def __enter__(self) -> None:
+        self.previous_verbosity = hf_logging.get_verbosity()
         hf_logging.set_verbosity_error()
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        hf_logging.set_verbosity_info()
+        hf_logging.set_verbosity(self.previous_verbosity)
+
+
+@cache
+def get_num_devices() -> int:
+    """Get the number of devices to train on.
+
+    The result is cached, so the CUDA driver is only queried once per process.
+
+    Returns:
+        The number of CUDA devices, or 1 if there are none.
+    """
+    return max(torch.cuda.device_count(), 1)
 
 
 @contextlib.contextmanager
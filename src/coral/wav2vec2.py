@@ -31,7 +31,7 @@ from transformers.trainer import OptimizerNames
 
 from .compute_metrics import compute_wer_metrics
 from .protocols import PreTrainedModelData, Processor
-from .utils import transformers_output_ignored
+from .utils import get_num_devices, transformers_output_ignored
 
 logger = logging.getLogger(__package__)
 
@@ -208,7 +208,7 @@ class Wav2Vec2ModelSetup:
 
     def load_training_arguments(self) -> TrainingArguments:
         # Compute the gradient accumulation based on the total batch size in the config
-        num_devices = max(torch.cuda.device_count(), 1)
+        num_devices = get_num_devices()
         per_device_total_batch_size = self.cfg.total_batch_size // num_devices
         gradient_accumulation_steps = (
             per_device_total_batch_size // self.cfg.per_device_batch_size
@@ -224,6 +224,24 @@ class Wav2Vec2ModelSetup:
             )
             gradient_accumulation_steps = 1
 
+        # Mixed precision with bfloat16 requires an Ampere GPU or newer, in which case
+        # we also allow TensorFloat-32 for the matrix multiplications that remain in
+        # fp32. We check the compute capability, as `torch.cuda.is_bf16_supported` also
+        # accepts older GPUs which only emulate bfloat16, and which don't support TF32
+        bf16 = (
+            self.cfg.bf16
+            and torch.cuda.is_available()
+            and torch.cuda.get_device_capability()[0] >= 8
+        )
+
+        # The default backend of `torch.compile` requires a GPU with compute capability
+        # 7.0 or higher
+        torch_compile = (
+            self.cfg.torch_compile
+            and torch.cuda.is_available()
+            and torch.cuda.get_device_capability()[0] >= 7
+        )
+
         do_eval = any(
             [
                 dataset_cfg.val_name is not None
@@ -240,7 +258,11 @@ class Wav2Vec2ModelSetup:
             lr_scheduler_type=SchedulerType.COSINE,
             warmup_steps=self.cfg.warmup_steps,
             max_steps=self.cfg.max_steps,
-            fp16=self.cfg.fp16 and not mps_is_available(),
+            fp16=self.cfg.fp16 and not bf16 and not mps_is_available(),
+            bf16=bf16,
+            bf16_full_eval=bf16,
+            tf32=True if bf16 else None,
+            torch_compile=torch_compile,
             push_to_hub=self.cfg.push_to_hub,
             evaluation_strategy="steps" if do_eval else "no",
             eval_steps=self.cfg.eval_steps if do_eval else None,
@@ -255,7 +277,7 @@ class Wav2Vec2ModelSetup:
             greater_is_better=False if do_eval else None,
             seed=self.cfg.seed,
             remove_unused_columns=False,
-            optim=OptimizerNames.ADAMW_TORCH,
+            optim=OptimizerNames(self.cfg.optimizer),
             adam_beta1=self.cfg.adam_first_momentum,
             adam_beta2=self.cfg.adam_second_momentum,
             report_to=["wandb"] if self.cfg.wandb else [],
@@ -264,6 +286,7 @@ class Wav2Vec2ModelSetup:
             use_cpu=hasattr(sys, "_called_from_test"),
             dataloader_num_workers=self.cfg.dataloader_num_workers,
             ddp_find_unused_parameters=False,
+            ddp_bucket_cap_mb=self.cfg.ddp_bucket_cap_mb,
         )
         return args
 
@@ -24,7 +24,7 @@ from transformers.trainer import OptimizerNames
 
 from .compute_metrics import compute_wer_metrics
 from .protocols import PreTrainedModelData, Processor
-from .utils import transformers_output_ignored
+from .utils import get_num_devices, transformers_output_ignored
 
 logger = logging.getLogger(__package__)
 
@@ -87,6 +87,11 @@ class DataCollatorSpeechSeq2SeqWithPadding(DataCollatorMixin):
             max_length=16_000 * self.max_seconds_per_example,
         )
 
+        # The spectrograms are stored in half precision, so we upcast them to the
+        # precision of the model. Mixed precision training casts them down as needed
+        if "input_features" in batch:
+            batch["input_features"] = batch["input_features"].float()
+
         # Get the tokenized label sequences
         label_features = [{"input_ids": feature["labels"]} for feature in features]
 
@@ -134,6 +139,7 @@ class WhisperModelSetup:
         with transformers_output_ignored():
             model = WhisperForConditionalGeneration.from_pretrained(
                 self.cfg.model.pretrained_model_id,
+                attn_implementation=self.cfg.model.attn_implementation,
                 dropout=self.cfg.model.dropout,
                 activation_dropout=self.cfg.model.activation_dropout,
                 attention_dropout=self.cfg.model.attention_dropout,
@@ -148,11 +154,15 @@ class WhisperModelSetup:
             )
             assert isinstance(model, WhisperForConditionalGeneration)
 
+        # The feature encoder of Whisper consists of the convolutional layers that
+        # are applied to the log-mel spectrograms, before the transformer layers
         if self.cfg.model.freeze_feature_encoder:
-            for param in model.parameters():
-                param.requires_grad = False
-            for param in model.proj_out.parameters():
-                param.requires_grad = True
+            for conv in [model.model.encoder.conv1, model.model.encoder.conv2]:
+                for param in conv.parameters():
+                    param.requires_grad = False
+
+        if self.cfg.model.freeze_encoder:
+            model.freeze_encoder()
 
         # The Whisper model has token ids that are forced as model outputs before
         # autoregressive generation is started (forced_decoder_ids). These token ids
@@ -186,7 +196,7 @@ class WhisperModelSetup:
 
     def load_training_arguments(self) -> TrainingArguments:
         # Compute the gradient accumulation based on the total batch size in the config
-        num_devices = max(torch.cuda.device_count(), 1)
+        num_devices = get_num_devices()
         per_device_total_batch_size = self.cfg.total_batch_size // num_devices
         gradient_accumulation_steps = (
             per_device_total_batch_size // self.cfg.per_device_batch_size
@@ -202,6 +212,24 @@ class WhisperModelSetup:
             )
             gradient_accumulation_steps = 1
 
+        # Mixed precision with bfloat16 requires an Ampere GPU or newer, in which case
+        # we also allow TensorFloat-32 for the matrix multiplications that remain in
+        # fp32. We check the compute capability, as `torch.cuda.is_bf16_supported` also
+        # accepts older GPUs which only emulate bfloat16, and which don't support TF32
+        bf16 = (
+            self.cfg.bf16
+            and torch.cuda.is_available()
+            and torch.cuda.get_device_capability()[0] >= 8
+        )
+
+        # The default backend of `torch.compile` requires a GPU with compute capability
+        # 7.0 or higher
+        torch_compile = (
+            self.cfg.torch_compile
+            and torch.cuda.is_available()
+            and torch.cuda.get_device_capability()[0] >= 7
+        )
+
         do_eval = any(
             [
                 dataset_cfg.val_name is not None
@@ -217,7 +245,11 @@ class WhisperModelSetup:
             learning_rate=self.cfg.learning_rate,
             warmup_steps=self.cfg.warmup_steps,
             max_steps=self.cfg.max_steps,
-            fp16=self.cfg.fp16 and not mps_is_available(),
+            fp16=self.cfg.fp16 and not bf16 and not mps_is_available(),
+            bf16=bf16,
+            bf16_full_eval=bf16,
+            tf32=True if bf16 else None,
+            torch_compile=torch_compile,
             push_to_hub=self.cfg.push_to_hub,
             evaluation_strategy="steps" if do_eval else "no",
             eval_steps=self.cfg.eval_steps if do_eval else None,
@@ -225,13 +257,17 @@ class WhisperModelSetup:
             logging_steps=self.cfg.logging_steps,
             length_column_name="input_length",
             gradient_checkpointing=True,
+            # The reentrant variant of gradient checkpointing only backpropagates
+            # through a checkpointed layer if its inputs require gradients, which is
+            # not the case for the encoder layers when the feature encoder is frozen
+            gradient_checkpointing_kwargs=dict(use_reentrant=False),
             save_total_limit=self.cfg.save_total_limit,
             load_best_model_at_end=self.cfg.early_stopping if do_eval else False,
             metric_for_best_model="wer" if do_eval else None,
             greater_is_better=False if do_eval else None,
             seed=self.cfg.seed,
             remove_unused_columns=False,
-            optim=OptimizerNames.ADAMW_TORCH,
+            optim=OptimizerNames(self.cfg.optimizer),
             report_to=["wandb"] if self.cfg.wandb else [],
             ignore_data_skip=self.cfg.ignore_data_skip,
             save_safetensors=True,
@@ -240,6 +276,7 @@ class WhisperModelSetup:
             use_cpu=hasattr(sys, "_called_from_test"),
             dataloader_num_workers=self.cfg.dataloader_num_workers,
             ddp_find_unused_parameters=False,
+            ddp_bucket_cap_mb=self.cfg.ddp_bucket_cap_mb,
         )
         return args
 
@@ -6,6 +6,8 @@ Usage:
 
 import logging
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import click
@@ -70,20 +72,32 @@ def main(raw_data_dir: str | Path, output_dir: str | Path) -> None:
         df["src_fname"] = df.utterance_id.map(
             lambda id_str: "_".join(id_str.split("_")[1:3])
         )
-        for src_name in tqdm(df.src_fname.unique(), desc=split, leave=False):
-            split_audio(
-                records=df.query("src_fname == @src_name").to_dict("records"),
-                input_dir=input_dir,
-            )
-
-    # Add an `audio` column to the dataframes, containing the paths to the audio files
+        records_per_source = [
+            records.to_dict("records")
+            for _, records in df.groupby("src_fname", sort=False)
+        ]
+
+        # Decoding, slicing and encoding the audio is CPU-bound, so we split the audio
+        # files in separate processes. Each process holds a full decoded recording in
+        # memory, and we leave a CPU free, as elsewhere
+        num_workers = max(1, mp.cpu_count() - 1)
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for _ in tqdm(
+                iterable=executor.map(
+                    partial(split_audio, input_dir=input_dir), records_per_source
+                ),
+                total=len(records_per_source),
+                desc=split,
+                leave=False,
+            ):
+                pass
+
+    # Add an `audio` column to the dataframes, containing the paths to the audio files.
+    # The directory is only resolved once, and the filenames are joined onto it as a
+    # vectorised string operation
+    resolved_audio_dir = str(processed_audio_path.resolve())
     for split, df in dfs.items():
-        audio_paths: list[str] = list()
-        for _, row in df.iterrows():
-            filename: str = row.utterance_id + ".wav"
-            audio_path: Path = input_dir / "processed_audio" / filename
-            audio_paths.append(str(audio_path.resolve()))
-        df["audio"] = audio_paths
+        df["audio"] = resolved_audio_dir + "/" + df.utterance_id + ".wav"
         dfs[split] = df
 
     # Remove unused columns
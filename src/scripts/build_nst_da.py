@@ -7,10 +7,12 @@ Usage:
 import datetime as dt
 import logging
 import multiprocessing as mp
+import os
 import re
 import shutil
 import tarfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import click
@@ -73,7 +75,7 @@ def stream_download(url: str, destination_path: str | Path) -> None:
     """
     streamer = rq.get(url, stream=True)
     total_size_in_bytes = int(streamer.headers.get("content-length", 0))
-    block_size = 1024
+    block_size = 1 << 20
     with Path(destination_path).open(mode="wb") as f:
         pbar = tqdm(
             desc=f"Downloading {url.split('/')[-1]}",
@@ -93,15 +95,21 @@ def uncompress_file(filename: str | Path) -> None:
         filename: The path to the file to uncompress.
     """
     filename = str(filename)
+
+    # The tarballs are opened in streaming mode, as they are then decompressed in a
+    # single sequential pass. In random access mode, `extractall` first decompresses
+    # the whole archive to list its members, and then decompresses it again to extract
+    # them. The archives are furthermore read in blocks of 1 MiB rather than the
+    # default 10 KiB
     match get_suffix(filename):
         case ".tar.gz":
             logger.info(f"Uncompressing {filename}")
-            with tarfile.open(filename, mode="r:gz") as tar:
+            with tarfile.open(filename, mode="r|gz", bufsize=1 << 20) as tar:
                 tar.extractall(path=filename.replace(".tar.gz", ""))
             Path(filename).unlink()
         case ".tar.xz":
             logger.info(f"Uncompressing {filename}")
-            with tarfile.open(filename, mode="r:xz") as tar:
+            with tarfile.open(filename, mode="r|xz", bufsize=1 << 20) as tar:
                 tar.extractall(path=filename.replace(".tar.xz", ""))
             Path(filename).unlink()
         case ".zip":
@@ -139,11 +147,10 @@ def reorganise_files(dataset_dir: str | Path) -> None:
                 shutil.move(data_dir / "metadata", train_dir)
             case "train_audio":
                 raw_dir = name_dir / "dk"
-                for audio_dir in raw_dir.iterdir():
-                    if not audio_dir.is_dir():
-                        continue
-                    for audio_file in audio_dir.glob("*.wav"):
-                        Path(audio_file).rename(train_audio_dir / audio_file.name)
+                move_audio_files(
+                    audio_dirs=list_subdirectories(directory=raw_dir),
+                    destination_dir=train_audio_dir,
+                )
                 shutil.rmtree(name_dir)
 
             # This file contains the test set as well as some corrections of errors in
@@ -152,11 +159,10 @@ def reorganise_files(dataset_dir: str | Path) -> None:
                 raw_dir = name_dir / "supplement_dk"
 
                 temp_test_audio_dir = raw_dir / "testdata" / "audio"
-                for audio_dir in temp_test_audio_dir.iterdir():
-                    if not audio_dir.is_dir():
-                        continue
-                    for audio_file in audio_dir.glob("*.wav"):
-                        Path(audio_file).rename(test_audio_dir / audio_file.name)
+                move_audio_files(
+                    audio_dirs=list_subdirectories(directory=temp_test_audio_dir),
+                    destination_dir=test_audio_dir,
+                )
                 temp_test_metadata_dir = raw_dir / "testdata" / "metadata"
                 shutil.move(temp_test_metadata_dir, test_dir)
 
@@ -180,6 +186,25 @@ def reorganise_files(dataset_dir: str | Path) -> None:
                 name_dir.rename(data_dir / "README.pdf")
 
 
+def move_audio_files(audio_dirs: list[str], destination_dir: Path) -> None:
+    """Move the audio files in a list of directories into a single directory.
+
+    The directories are listed and their files moved in parallel threads, as this is
+    bound by the latency of the file system rather than by the CPU.
+
+    Args:
+        audio_dirs: The directories containing the audio files.
+        destination_dir: The directory to move the audio files to.
+    """
+
+    def move_directory(audio_dir: str) -> None:
+        for audio_file in list_audio_files(audio_dir=audio_dir):
+            os.rename(audio_file, destination_dir / os.path.basename(audio_file))
+
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(move_directory, audio_dirs))
+
+
 def remove_bad_files(dataset_dir: Path | str) -> None:
     """Remove audio files that cannot be opened.
 
@@ -190,19 +215,14 @@ def remove_bad_files(dataset_dir: Path | str) -> None:
 
     # These filename prefixes were found by running the `find_faulty_audio_clips.py`
     # script
-    bad_file_prefixes = [
+    bad_file_prefixes = (
         "dk11x242-18072000-1149_u0047",
         "dk16xx41-24092000-1951_u0042",
-    ]
+    )
     for split in ["train", "test"]:
         audio_dir = dataset_dir / split / "audio"
-        for audio_file in audio_dir.glob("*.wav"):
-            if any(
-                [
-                    audio_file.stem.startswith(bad_prefix)
-                    for bad_prefix in bad_file_prefixes
-                ]
-            ):
+        for audio_file in map(Path, list_audio_files(audio_dir=audio_dir)):
+            if audio_file.stem.startswith(bad_file_prefixes):
                 logger.info(f"Removing {audio_file} as it cannot be opened.")
                 audio_file.unlink()
                 continue
@@ -217,6 +237,35 @@ def remove_bad_files(dataset_dir: Path | str) -> None:
                 audio_file.unlink()
 
 
+def list_audio_files(audio_dir: Path | str) -> list[str]:
+    """List the .wav files directly inside a directory.
+
+    This uses `os.scandir` rather than `Path.glob`, which avoids creating a `Path`
+    object and possibly calling `stat` for every entry in the directory.
+
+    Args:
+        audio_dir: The directory to list the audio files of.
+
+    Returns:
+        The paths to the audio files.
+    """
+    with os.scandir(audio_dir) as entries:
+        return [entry.path for entry in entries if entry.name.endswith(".wav")]
+
+
+def list_subdirectories(directory: Path | str) -> list[str]:
+    """List the subdirectories directly inside a directory.
+
+    Args:
+        directory: The directory to list the subdirectories of.
+
+    Returns:
+        The paths to the subdirectories.
+    """
+    with os.scandir(directory) as entries:
+        return [entry.path for entry in entries if entry.is_dir()]
+
+
 def get_suffix(string: str | Path) -> str:
     """Get the suffix of a string.
 
@@ -236,6 +285,30 @@ def get_suffix(string: str | Path) -> str:
         return ""
 
 
+def build_audio_filename_index(
+    audio_filenames: list[str],
+) -> dict[tuple[str, str], list[str]]:
+    """Index audio filenames by the timestamps and old filenames they contain.
+
+    The reorganised NST filenames contain the time of the recording in the format
+    HHMM, followed by a dash or an underscore and the old filename.
+
+    Args:
+        audio_filenames: The audio filenames to index.
+
+    Returns:
+        A mapping from pairs of timestamps and old filenames to the audio filenames
+        containing them, in the order in which they appear in `audio_filenames`.
+    """
+    index: dict[tuple[str, str], list[str]] = dict()
+    for audio_filename in audio_filenames:
+        parts = re.split(r"[-_]", Path(audio_filename).stem)
+        keys = {(part[-4:], next_part) for part, next_part in zip(parts, parts[1:])}
+        for key in keys:
+            index.setdefault(key, list()).append(audio_filename)
+    return index
+
+
 def build_huggingface_dataset(dataset_dir: Path | str) -> DatasetDict:
     """Sets up the metadata files and builds the Hugging Face dataset.
 
@@ -295,8 +368,9 @@ def build_huggingface_dataset(dataset_dir: Path | str) -> DatasetDict:
         # names of the audio files, so we extract the audio filename from the
         # information within the metadata filename
         audio_dir = dataset_dir / split / "audio"
-        audio_filenames = pd.Series(
-            [str(audio_file) for audio_file in audio_dir.glob("*.wav")]
+        audio_filenames = list_audio_files(audio_dir=audio_dir)
+        audio_filename_index = build_audio_filename_index(
+            audio_filenames=audio_filenames
         )
         recording_datetimes: list[str] = list()
         for idx, row in tqdm(
@@ -318,11 +392,9 @@ def build_huggingface_dataset(dataset_dir: Path | str) -> DatasetDict:
 
             # We next get the filename candidates which has the same old filename as
             # well as the same timestamp
-            filename_content = datetime.strftime("%H%M") + "[-_]" + original_filename
-            filename_candidate_idxs = (
-                audio_filenames.str.contains(filename_content).to_numpy().nonzero()[0]
+            filename_candidates = audio_filename_index.get(
+                (datetime.strftime("%H%M"), original_filename), []
             )
-            filename_candidates = audio_filenames[filename_candidate_idxs]
 
             # If no such filename exists then we set the filename to None, and we will
             # later remove these rows
@@ -341,8 +413,10 @@ def build_huggingface_dataset(dataset_dir: Path | str) -> DatasetDict:
         metadata_df = metadata_df.dropna()
         metadata_df = metadata_df.drop(columns=["recording_date", "recording_time"])
 
-        # Remove non-existent audio files
-        audio_exists = metadata_df.audio.map(lambda path: Path(path).exists())
+        # Remove non-existent audio files. These are checked against the listing of
+        # the audio directory in a single hashed lookup, rather than with a `stat` call
+        # for every row
+        audio_exists = metadata_df.audio.isin(audio_filenames)
         metadata_df = metadata_df[audio_exists]
 
         metadata_df.to_csv(metadata_path, index=False)
@@ -50,18 +50,16 @@ def preprocess_transcriptions(
         example["input_length"] = len(example["labels"])
         return example
 
-    mapped = dataset.map(tokenize_examples)
-
-    # After calling `map` the DatasetInfo is lost, so we need to add it back in
-    for split in dataset.keys():
-        mapped[split]._info = dataset[split]._info
-        mapped[split]._info.features["labels"] = Sequence(
-            feature=Value(dtype="int64"), length=-1
-        )
-        mapped[split]._info.features["input_length"] = Value(dtype="int64")
-        mapped[split]._info = dataset[split]._info
-
-    return mapped
+    mapped: dict = dict()
+    for split, split_dataset in dataset.items():
+        features = split_dataset.features.copy()
+        features["labels"] = Sequence(feature=Value(dtype="int64"), length=-1)
+        features["input_length"] = Value(dtype="int64")
+        mapped[split] = split_dataset.map(tokenize_examples, features=features)
+
+    if isinstance(dataset, DatasetDict):
+        return DatasetDict(mapped)
+    return IterableDatasetDict(mapped)
 
 
 if __name__ == "__main__":
@@ -5,7 +5,9 @@ Usage:
 """
 
 import logging
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import click
@@ -25,21 +27,53 @@ def main(audio_dir: str | Path) -> None:
         audio_dir: Path to directory containing audio clips.
     """
     audio_dir = Path(audio_dir)
-    folders = [folder for folder in audio_dir.iterdir() if folder.is_dir()]
+    with os.scandir(audio_dir) as entries:
+        folders = [Path(entry.path) for entry in entries if entry.is_dir()]
     folders += [audio_dir]
-    for folder in tqdm(folders, desc=f"Checking {audio_dir} for faulty audio files"):
-        for audio_file in tqdm(
-            iterable=list(folder.glob("*.wav")),
-            desc=f"Checking {folder}",
-            leave=False,
+
+    # The warnings raised when loading the audio files are ignored. The filters are
+    # process-wide, so they are set once here rather than in every worker thread
+    warnings.simplefilter("ignore", category=UserWarning)
+    warnings.simplefilter("ignore", category=FutureWarning)
+
+    max_workers = min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        audio_files = [
+            audio_file
+            for folder_audio_files in executor.map(list_audio_files, folders)
+            for audio_file in folder_audio_files
+        ]
+        for _ in tqdm(
+            iterable=executor.map(check_audio_file, audio_files),
+            total=len(audio_files),
+            desc=f"Checking {audio_dir} for faulty audio files",
         ):
-            try:
-                with warnings.catch_warnings():
-                    warnings.simplefilter("ignore", category=UserWarning)
-                    warnings.simplefilter("ignore", category=FutureWarning)
-                    librosa.load(audio_file)
-            except Exception as e:
-                logger.error(f"Could not open {audio_file!r}. The error was: {e}")
+            pass
+
+
+def list_audio_files(folder: Path) -> list[Path]:
+    """Lists the .wav files directly inside a folder.
+
+    Args:
+        folder: Path to the folder.
+
+    Returns:
+        The paths to the .wav files in the folder.
+    """
+    with os.scandir(folder) as entries:
+        return [Path(entry.path) for entry in entries if entry.name.endswith(".wav")]
+
+
+def check_audio_file(audio_file: Path) -> None:
+    """Tries to open an audio file, and logs an error if it cannot be opened.
+
+    Args:
+        audio_file: Path to the audio file.
+    """
+    try:
+        librosa.load(audio_file, sr=None)
+    except Exception as e:
+        logger.error(f"Could not open {audio_file!r}. The error was: {e}")
 
 
 if __name__ == "__main__":
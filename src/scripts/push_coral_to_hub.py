@@ -12,58 +12,66 @@ Usage:
             [--max_num_conversation_recordings <value>]
 """
 
-import os
-from pathlib import Path
-from datasets import Dataset, Audio, DatasetDict
-from datetime import datetime
-from huggingface_hub import HfApi
-import pandas as pd
-import click
+import importlib.util
 import logging
+import os
 import time
+from datetime import datetime
+from pathlib import Path
+
+# Upload the dataset shards with the Rust-based `hf_transfer` package if it is
+# installed, which uploads the shards in parallel chunks. This has to be enabled before
+# `huggingface_hub` is imported
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
 
-from requests import HTTPError
+import click  # noqa: E402
+import pandas as pd  # noqa: E402
+from datasets import Audio, Dataset, DatasetDict, Features, Value  # noqa: E402
+from huggingface_hub import HfApi  # noqa: E402
+from requests import HTTPError  # noqa: E402
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(message)s")
 logger = logging.getLogger(__name__)
 
 FIRST_ITERATION_END = "2024-03-15T00:00:00+02:00"
-TEST_SPEAKER_IDS = [
-    "t16023910",
-    "t22996947",
-    "t17053799",
-    "t47310812",
-    "t59821643",
-    "t79384144",
-    "t37263163",
-    "t39126337",
-    "t22996947",
-    "t17419826",
-    "t29982093",
-    "t40224720",
-    "t27567090",
-    "t31776488",
-    "t40353825",
-    "t34653502",
-    "t26322580",
-    "t72771561",
-    "t48392154",
-    "t38841910",
-    "t36170006",
-    "t10062436",
-    "t21820268",
-    "t39414039",
-    "t13282221",
-    "t82923090",
-    "t35107011",
-    "t13330719",
-    "t33840200",
-    "t10367179",
-    "t39656524",
-    "t37619007",
-    "t42345465",
-    "t21902156",
-]
+TEST_SPEAKER_IDS = frozenset(
+    {
+        "t16023910",
+        "t22996947",
+        "t17053799",
+        "t47310812",
+        "t59821643",
+        "t79384144",
+        "t37263163",
+        "t39126337",
+        "t17419826",
+        "t29982093",
+        "t40224720",
+        "t27567090",
+        "t31776488",
+        "t40353825",
+        "t34653502",
+        "t26322580",
+        "t72771561",
+        "t48392154",
+        "t38841910",
+        "t36170006",
+        "t10062436",
+        "t21820268",
+        "t39414039",
+        "t13282221",
+        "t82923090",
+        "t35107011",
+        "t13330719",
+        "t33840200",
+        "t10367179",
+        "t39656524",
+        "t37619007",
+        "t42345465",
+        "t21902156",
+    }
+)
 
 
 @click.command("Builds and pushes the CoRal test dataset.")
@@ -206,20 +214,12 @@ def main(
         get_iteration_name
     )
 
-    test_recordings = []
-    train_recordings = []
-    for _, row in recording_metadata.iterrows():
-        if any(
-            [
-                speaker_id in TEST_SPEAKER_IDS
-                for speaker_id in [row["speaker_id_1"], row["speaker_id_2"]]
-            ]
-        ):
-            test_recordings.append(row)
-        else:
-            train_recordings.append(row)
-    test_recordings_df = pd.DataFrame(test_recordings)
-    train_recordings_df = pd.DataFrame(train_recordings)
+    # A recording belongs to the test set if any of its speakers is a test speaker
+    is_test_recording = recording_metadata["speaker_id_1"].isin(
+        TEST_SPEAKER_IDS
+    ) | recording_metadata["speaker_id_2"].isin(TEST_SPEAKER_IDS)
+    test_recordings_df = recording_metadata[is_test_recording]
+    train_recordings_df = recording_metadata[~is_test_recording]
 
     # Load the speaker metadata
     speaker_metadata_path = Path(speaker_metadata_path)
@@ -274,20 +274,11 @@ def main(
     # Pick a validation set from the training set, by selecting a single recording
     # from each speaker. If make sure we do not select too many conversation
     # recordings, as these are typically longer and might skew the validation set.
-    validation_recordings = []
-    for speaker_id in train_recordings_df["speaker_id_1"].unique():
-        recording = train_recordings_df[
-            train_recordings_df["speaker_id_1"] == speaker_id
-        ].iloc[0]
-        if (
-            "conversation" in recording["filename"]
-            and max_num_conversation_recordings > 0
-        ):
-            validation_recordings.append(recording)
-            max_num_conversation_recordings -= 1
-        elif "conversation" not in recording["filename"]:
-            validation_recordings.append(recording)
-    validation_recordings_df = pd.DataFrame(validation_recordings).astype(str)
+    first_recordings_df = train_recordings_df.drop_duplicates(subset="speaker_id_1")
+    is_conversation = first_recordings_df["filename"].str.contains("conversation")
+    validation_recordings_df = first_recordings_df[
+        ~is_conversation | (is_conversation.cumsum() <= max_num_conversation_recordings)
+    ].astype(str)
 
     # Remove the validation recordings from the training set
     train_recordings_df = train_recordings_df[
@@ -316,14 +307,9 @@ def main(
     )
 
     # Create the dataset
-    testset = Dataset.from_pandas(test_read_aloud_df).cast_column("filename", Audio())
-    trainset_read = Dataset.from_pandas(train_read_aloud_df).cast_column(
-        "filename", Audio()
-    )
-    validationset = Dataset.from_dict(validation_read_aloud_df).cast_column(
-        "filename",
-        Audio(),
-    )
+    testset = build_dataset(recordings_df=test_read_aloud_df)
+    trainset_read = build_dataset(recordings_df=train_read_aloud_df)
+    validationset = build_dataset(recordings_df=validation_read_aloud_df)
     dataset_dict = DatasetDict(
         {
             "test": testset,
@@ -374,6 +360,33 @@ def main(
     push_to_hub(dataset_dict, hub_id_v, private)
 
 
+def build_dataset(recordings_df: pd.DataFrame) -> Dataset:
+    """Build a dataset from a dataframe of recordings.
+
+    All the metadata columns are strings, and the `filename` column contains the paths
+    to the audio files. The schema is given up front, so that the audio paths are
+    encoded directly into the `Audio` feature, instead of inferring the schema and
+    casting the `filename` column afterwards. The dataframe columns are converted
+    directly to Arrow arrays, without first pivoting them into Python lists.
+
+    Args:
+        recordings_df:
+            The recordings, where all the columns are strings.
+
+    Returns:
+        The dataset.
+    """
+    features = Features(
+        {
+            column: Audio() if column == "filename" else Value(dtype="string")
+            for column in recordings_df.columns
+        }
+    )
+    return Dataset.from_pandas(
+        df=recordings_df, features=features, preserve_index=False
+    )
+
+
 def push_to_hub(
     dataset_dict: DatasetDict,
     hub_id_v: str,
@@ -4,12 +4,20 @@ Usage:
     python push_to_hub.py <saved_dataset_dir> <hub_id> [--private]
 """
 
+import importlib.util
 import logging
+import os
 import time
 
-import click
-from datasets import DatasetDict
-from requests import HTTPError
+# Upload the dataset shards with the Rust-based `hf_transfer` package if it is
+# installed, which uploads the shards in parallel chunks. This has to be enabled before
+# `huggingface_hub` is imported
+if importlib.util.find_spec("hf_transfer") is not None:
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+
+import click  # noqa: E402
+from datasets import DatasetDict  # noqa: E402
+from requests import HTTPError  # noqa: E402
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(message)s")
 logger = logging.getLogger(__name__)
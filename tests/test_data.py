@@ -5,7 +5,15 @@ import re
 import pytest
 from datasets import DatasetDict, IterableDatasetDict
 
-from coral.data import clean_example
+from coral.data import (
+    MIN_EXAMPLES_PER_PROCESS,
+    NUM_CPUS,
+    clean_example,
+    clean_examples,
+    compile_conversion_dict,
+    get_num_proc,
+    load_data,
+)
 
 
 class TestLoadData:
@@ -28,6 +36,12 @@ class TestLoadData:
                 "men hendes vilje var fast som hendes tillid til vorherre",
             ]
 
+    def test_no_datasets(self, cfg) -> None:
+        cfg = cfg.copy()
+        cfg.datasets = dict()
+        with pytest.raises(AssertionError, match="No datasets were loaded"):
+            load_data(cfg)
+
 
 class TestCleanExample:
     transcription = "\nThis is a (test) [sentence]\u0301 with \n{aa} and ğ. "
@@ -121,6 +135,30 @@ class TestCleanExample:
         cleaned_transcription = clean_example(
             example=example,
             non_standard_characters_regex=non_standard_characters_regex,
-            conversion_dict=conversion_dict,
+            conversion_stages=compile_conversion_dict(conversion_dict=conversion_dict),
         )["text"]
         assert cleaned_transcription == expected
+
+    def test_clean_examples(self) -> None:
+        conversion_stages = compile_conversion_dict(
+            conversion_dict=self.diacritics_conversion_dict
+        )
+        examples = dict(text=[self.transcription, "AA og ğ"])
+        cleaned_transcriptions = clean_examples(
+            examples=examples,
+            non_standard_characters_regex=self.parens_regex,
+            conversion_stages=conversion_stages,
+        )["text"]
+        assert cleaned_transcriptions == [
+            "this is a test sentence\u0301 with \nå and g.",
+            "aa og g",
+        ]
+
+
+class TestGetNumProc:
+    def test_small_dataset(self) -> None:
+        assert get_num_proc(num_examples=MIN_EXAMPLES_PER_PROCESS - 1) == 1
+
+    def test_large_dataset(self) -> None:
+        num_examples = MIN_EXAMPLES_PER_PROCESS * (NUM_CPUS + 1)
+        assert get_num_proc(num_examples=num_examples) == max(1, NUM_CPUS - 1)
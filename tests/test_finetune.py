@@ -1,7 +1,113 @@
 """Unit tests for the `finetune` module."""
 
-from coral.finetune import finetune
+import itertools as it
+import time
+from typing import Iterator
+
+import pytest
+
+from coral.finetune import (
+    LengthGroupedIterableDataset,
+    PrefetchedIterableDataset,
+    finetune,
+)
 
 
 def test_finetune(cfg):
     finetune(cfg)
+
+
+class CountingDataset:
+    """Infinite dataset which counts the number of examples that have been read."""
+
+    def __init__(self) -> None:
+        """Initialise the dataset."""
+        self.num_examples_read = 0
+
+    def __iter__(self) -> Iterator[int]:
+        """Iterate over the examples in the dataset.
+
+        Yields:
+            The examples in the dataset.
+        """
+        for example in it.count():
+            self.num_examples_read += 1
+            yield example
+
+
+def failing_dataset() -> Iterator[int]:
+    """Dataset which fails after yielding two examples.
+
+    Yields:
+        The examples in the dataset.
+    """
+    yield 0
+    yield 1
+    raise ValueError("The dataset failed.")
+
+
+class TestPrefetchedIterableDataset:
+    def test_order_is_preserved(self) -> None:
+        dataset = PrefetchedIterableDataset(dataset=list(range(100)), buffer_size=4)
+        assert list(dataset) == list(range(100))
+
+    def test_can_be_iterated_several_times(self) -> None:
+        dataset = PrefetchedIterableDataset(dataset=list(range(10)), buffer_size=4)
+        assert list(dataset) == list(dataset)
+
+    def test_exceptions_are_propagated(self) -> None:
+        dataset = PrefetchedIterableDataset(dataset=failing_dataset(), buffer_size=4)
+        examples: list[int] = list()
+        with pytest.raises(ValueError, match="The dataset failed."):
+            for example in dataset:
+                examples.append(example)
+        assert examples == [0, 1]
+
+    def test_prefetching_stops_when_consumer_exits(self) -> None:
+        counting_dataset = CountingDataset()
+        dataset = PrefetchedIterableDataset(dataset=counting_dataset, buffer_size=4)
+        iterator = iter(dataset)
+        assert list(it.islice(iterator, 3)) == [0, 1, 2]
+        iterator.close()
+        time.sleep(0.5)
+        num_examples_read = counting_dataset.num_examples_read
+        time.sleep(0.5)
+        assert counting_dataset.num_examples_read == num_examples_read
+        assert num_examples_read <= 3 + 4 + 2
+
+
+class TestLengthGroupedIterableDataset:
+    lengths = [5, 1, 7, 3, 2, 8, 6, 4, 9, 0]
+    examples = [
+        dict(example_id=example_id, labels=[0] * length)
+        for example_id, length in enumerate(lengths)
+    ]
+
+    @pytest.fixture
+    def grouped_examples(self) -> list[dict]:
+        dataset = LengthGroupedIterableDataset(
+            dataset=self.examples, batch_size=2, buffer_size=4, seed=4242
+        )
+        return list(dataset)
+
+    def test_all_examples_are_yielded_once(self, grouped_examples) -> None:
+        example_ids = [example["example_id"] for example in grouped_examples]
+        assert sorted(example_ids) == list(range(len(self.examples)))
+
+    def test_examples_are_grouped_within_buffers(self, grouped_examples) -> None:
+        buffers = [grouped_examples[idx : idx + 4] for idx in range(0, 10, 4)]
+        for buffer, expected_batches in zip(
+            buffers, [[{1, 3}, {5, 7}], [{2, 4}, {6, 8}], [{0, 9}]]
+        ):
+            batches = [
+                {len(example["labels"]) for example in buffer[idx : idx + 2]}
+                for idx in range(0, len(buffer), 2)
+            ]
+            assert sorted(batches, key=min) == expected_batches
+
+    def test_set_epoch_without_dataset_support(self) -> None:
+        dataset = LengthGroupedIterableDataset(
+            dataset=self.examples, batch_size=2, buffer_size=4, seed=4242
+        )
+        dataset.set_epoch(1)
+        assert dataset.epoch == 1
@@ -2,9 +2,14 @@
 
 import datasets.utils.logging as ds_logging
 from datasets.utils import enable_progress_bar
+import torch
 import transformers.utils.logging as hf_logging
 
-from coral.utils import block_terminal_output, transformers_output_ignored
+from coral.utils import (
+    block_terminal_output,
+    get_num_devices,
+    transformers_output_ignored,
+)
 
 
 class output_blocked:
@@ -37,3 +42,37 @@ def test_transformers_output_ignored() -> None:
     assert hf_logging.get_verbosity() == hf_logging.INFO
     with transformers_output_ignored():
         assert hf_logging.get_verbosity() == hf_logging.ERROR
+
+
+def test_transformers_output_ignored_restores_verbosity() -> None:
+    hf_logging.set_verbosity_warning()
+    with transformers_output_ignored():
+        pass
+    assert hf_logging.get_verbosity() == hf_logging.WARNING
+
+
+def test_get_num_devices_is_cached(monkeypatch) -> None:
+    num_calls = 0
+
+    def device_count() -> int:
+        nonlocal num_calls
+        num_calls += 1
+        return 2
+
+    monkeypatch.setattr(torch.cuda, "device_count", device_count)
+    get_num_devices.cache_clear()
+    try:
+        assert get_num_devices() == 2
+        assert get_num_devices() == 2
+        assert num_calls == 1
+    finally:
+        get_num_devices.cache_clear()
+
+
+def test_get_num_devices_is_at_least_one(monkeypatch) -> None:
+    monkeypatch.setattr(torch.cuda, "device_count", lambda: 0)
+    get_num_devices.cache_clear()
+    try:
+        assert get_num_devices() == 1
+    finally:
+        get_num_devices.cache_clear()
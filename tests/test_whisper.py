@@ -1 +1,42 @@
 """Unit tests for the `whisper` module."""
+
+import torch
+from hydra import compose
+
+from coral.whisper import WhisperModelSetup
+
+
+def test_encoder_is_trained_with_frozen_feature_encoder() -> None:
+    """Test that the encoder is trained when only the convolutions are frozen."""
+    cfg = compose(
+        config_name="config",
+        overrides=[
+            "model=test_whisper",
+            "model.freeze_feature_encoder=true",
+            "model.freeze_encoder=false",
+            "fp16=false",
+        ],
+    )
+    model_setup = WhisperModelSetup(cfg=cfg)
+    model_setup.load_processor()
+    model = model_setup.load_model()
+    args = model_setup.load_training_arguments()
+
+    # Enable gradient checkpointing in the same way as the trainer does
+    model.gradient_checkpointing_enable(
+        gradient_checkpointing_kwargs=args.gradient_checkpointing_kwargs
+    )
+    model.train()
+
+    input_features = torch.randn(1, model.config.num_mel_bins, 3000)
+    labels = torch.tensor([[model.config.decoder_start_token_id, 1, 2, 3]])
+    model(input_features=input_features, labels=labels).loss.backward()
+
+    assert all(
+        param.grad is None
+        for conv in [model.model.encoder.conv1, model.model.encoder.conv2]
+        for param in conv.parameters()
+    )
+    assert all(
+        param.grad is not None for param in model.model.encoder.layers[0].parameters()
+    )